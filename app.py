@@ -2,11 +2,21 @@ import streamlit as st
 import os
 import io
 from PIL import Image
-import base64
 import warnings
 import google.generativeai as genai
 import tempfile
+import time
+import hashlib
+import html
+import re
+import zipfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from pptx import Presentation
+from session_store import SessionStore, SQLiteSessionStore, SessionQuotaExceeded
+from context_cache import get_context
 
 # Configure Streamlit page with custom CSS for better note presentation
 st.set_page_config(
@@ -23,22 +33,27 @@ try:
 except ImportError:
     pass
 
-# Initialize session state for notes type selection, storing generated notes, and chat history
+# Initialize session state for notes type selection and the id under which generated notes,
+# chat history and page renders are kept in the session store
 if 'selected_notes_type' not in st.session_state:
     st.session_state.selected_notes_type = None
-if 'notes_content' not in st.session_state:
-    st.session_state.notes_content = None
-if 'note_type' not in st.session_state:
-    st.session_state.note_type = None
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if 'rendered_pages' not in st.session_state:
+    st.session_state.rendered_pages = {}
+if 'thumbnail_futures' not in st.session_state:
+    st.session_state.thumbnail_futures = {}
+    st.session_state.thumbnails_polling = False
+if 'file_hash' not in st.session_state:
+    st.session_state.file_hash = None
+    st.session_state.file_hash_id = None
 
 # Define show_debug setting
 show_debug = True  # Set to True to see more debugging information
 
 # Set up pdf2image with poppler
 try:
-    from pdf2image import convert_from_bytes, convert_from_path
+    from pdf2image import convert_from_bytes, convert_from_path, pdfinfo_from_bytes
     PDF2IMAGE_AVAILABLE = True
     #st.sidebar.success("PDF2Image is available!")
 except ImportError:
@@ -55,6 +70,548 @@ else:
 # Set model to use (from environment variable or default)
 model_name = os.getenv("MODEL", "gemini-2.0-flash")
 
+# Session data store, shared by all sessions in this process. Set SESSION_STORE=sqlite to keep it in
+# a SQLite file (SESSION_STORE_PATH) that several app processes can share.
+@st.cache_resource
+def get_session_store():
+    limits = {
+        "max_bytes": int(float(os.getenv("SESSION_STORE_MAX_MB", "512")) * 1024 * 1024),
+        "max_session_bytes": int(float(os.getenv("SESSION_MAX_MB", "32")) * 1024 * 1024),
+        "idle_seconds": int(os.getenv("SESSION_IDLE_SECONDS", "3600")),
+    }
+    if os.getenv("SESSION_STORE", "memory").lower() == "sqlite":
+        return SQLiteSessionStore(os.getenv("SESSION_STORE_PATH", "sessions.db"), **limits)
+    return SessionStore(**limits)
+
+session_store = get_session_store()
+session_id = st.session_state.session_id
+session_store.touch(session_id)
+
+def delete_notes_if_unused(notes_hash, library):
+    if all(entry["notes_hash"] != notes_hash for entry in library):
+        session_store.delete(session_id, f"notes:{notes_hash}")
+
+def free_session_space(keep_hash=None):
+    """Make room in a full session: drop page renders first, then the oldest other library entry.
+
+    Returns False when there is nothing left to drop.
+    """
+    render_keys = [key for key in session_store.keys(session_id) if key.startswith("render:")]
+    if render_keys:
+        for key in render_keys:
+            session_store.delete(session_id, key)
+        st.session_state.rendered_pages = {}
+        return True
+    library = session_store.get_json(session_id, "notes_library", [])
+    for entry in library:
+        if entry["notes_hash"] != keep_hash:
+            library.remove(entry)
+            session_store.set_json(session_id, "notes_library", library)
+            delete_notes_if_unused(entry["notes_hash"], library)
+            return True
+    return False
+
+def write_with_quota(write, keep_hash=None):
+    """Run a session store write, freeing space in the session if it is over its limit"""
+    while True:
+        try:
+            return write()
+        except SessionQuotaExceeded:
+            if not free_session_space(keep_hash):
+                raise
+
+def save_chat_history(chat_history):
+    """Store the chat history, freeing other session data and then dropping the oldest exchanges if needed"""
+    current = session_store.get_json(session_id, "current_notes")
+    while True:
+        try:
+            write_with_quota(
+                lambda: session_store.set_json(session_id, "chat_history", chat_history),
+                keep_hash=current["notes_hash"] if current else None
+            )
+            return
+        except SessionQuotaExceeded:
+            if not chat_history:
+                raise
+            del chat_history[:2]
+
+def load_current_notes():
+    """Return the notes text and note type last generated in this session, or (None, None)"""
+    current = session_store.get_json(session_id, "current_notes")
+    if not current:
+        return None, None
+    return session_store.get_text(session_id, f"notes:{current['notes_hash']}"), current["note_type"]
+
+def get_chat_context(notes_content):
+    """Model context holding the notes and the seed turns, keyed by the notes.
+
+    Notes are usually below the model's minimum cacheable size, in which case they are resent
+    with each question, as is the chat history that follows them.
+    """
+    return get_context(
+        f"chat:{get_notes_hash(notes_content)}",
+        model_name,
+        contents=[
+            {"role": "user", "parts": [f"Here are the notes from the document: {notes_content}"]},
+            {"role": "model", "parts": ["Understood, I can answer questions about these notes."]}
+        ]
+    )
+
+def record_model_call(stage, response, started, context):
+    """Keep token usage and latency of the last model call for the debug sidebar"""
+    usage = getattr(response, "usage_metadata", None)
+    st.session_state.last_model_call = {
+        "stage": stage,
+        "seconds": time.time() - started,
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "cached_tokens": getattr(usage, "cached_content_token_count", None),
+        "server_cache": context.server_side,
+    }
+
+def load_notes_library():
+    """Return the notes generated in this session for every document, with their text"""
+    entries = session_store.get_json(session_id, "notes_library", [])
+    for entry in entries:
+        entry["notes_content"] = session_store.get_text(session_id, f"notes:{entry['notes_hash']}", "")
+    return entries
+
+# Set up optional exporters for HTML, DOCX and PDF downloads
+try:
+    import markdown as markdown_lib
+    MARKDOWN_AVAILABLE = True
+except ImportError:
+    MARKDOWN_AVAILABLE = False
+
+try:
+    from docx import Document as DocxDocument
+    DOCX_AVAILABLE = True
+except ImportError:
+    DOCX_AVAILABLE = False
+
+try:
+    from fpdf import FPDF
+    FPDF_AVAILABLE = True
+except ImportError:
+    FPDF_AVAILABLE = False
+
+# Export formats offered for notes, with file extension and MIME type
+EXPORT_FORMATS = {
+    "Markdown": {"ext": "md", "mime": "text/markdown"},
+    "HTML": {"ext": "html", "mime": "text/html"},
+    "DOCX": {"ext": "docx", "mime": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"},
+    "PDF": {"ext": "pdf", "mime": "application/pdf"},
+}
+
+def get_available_export_formats():
+    """Return the export formats whose libraries are installed"""
+    formats = ["Markdown", "HTML"]
+    if DOCX_AVAILABLE:
+        formats.append("DOCX")
+    if FPDF_AVAILABLE:
+        formats.append("PDF")
+    return formats
+
+def get_notes_hash(notes_content):
+    """Hash notes so rendered exports can be cached without hashing the full text on every rerun"""
+    return hashlib.sha256(notes_content.encode()).hexdigest()
+
+def get_export_filename(note_type, export_format, document_name=None):
+    stem = note_type.replace(' ', '_').lower()
+    if document_name:
+        stem = f"{os.path.splitext(document_name)[0]}_{stem}"
+    return f"{stem}.{EXPORT_FORMATS[export_format]['ext']}"
+
+# Markdown line patterns used by the DOCX and PDF exporters
+MD_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+MD_BULLET_RE = re.compile(r"^\s*[-*•]\s+(.*)$")
+MD_NUMBERED_RE = re.compile(r"^\s*\d+[.)]\s+(.*)$")
+MD_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+
+def notes_to_html(notes_content, note_type):
+    if MARKDOWN_AVAILABLE:
+        body = markdown_lib.markdown(notes_content, extensions=["tables", "fenced_code"])
+    else:
+        body = f"<pre>{html.escape(notes_content)}</pre>"
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(note_type)}</title>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+def notes_to_docx(notes_content):
+    document = DocxDocument()
+    for line in notes_content.splitlines():
+        if not line.strip():
+            continue
+        heading = MD_HEADING_RE.match(line)
+        if heading:
+            document.add_heading(MD_BOLD_RE.sub(r"\1", heading.group(2)), level=min(len(heading.group(1)), 4))
+            continue
+        bullet = MD_BULLET_RE.match(line)
+        numbered = MD_NUMBERED_RE.match(line)
+        if bullet:
+            paragraph = document.add_paragraph(style="List Bullet")
+            text = bullet.group(1)
+        elif numbered:
+            paragraph = document.add_paragraph(style="List Number")
+            text = numbered.group(1)
+        else:
+            paragraph = document.add_paragraph()
+            text = line.strip()
+        # Split on **bold** markers so emphasised key terms survive the export
+        for i, part in enumerate(MD_BOLD_RE.split(text)):
+            if part:
+                paragraph.add_run(part).bold = (i % 2 == 1)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+# Unicode TrueType fonts for PDF export (regular, bold), overridable with PDF_FONT_PATH/PDF_BOLD_FONT_PATH.
+# Without one, the exporter falls back to the Latin-1 core fonts.
+PDF_FONT_CANDIDATES = [
+    (os.getenv("PDF_FONT_PATH"), os.getenv("PDF_BOLD_FONT_PATH")),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ("/usr/share/fonts/TTF/DejaVuSans.ttf", "/usr/share/fonts/TTF/DejaVuSans-Bold.ttf"),
+    ("/Library/Fonts/Arial Unicode.ttf", None),
+    ("C:\\Windows\\Fonts\\arial.ttf", "C:\\Windows\\Fonts\\arialbd.ttf"),
+]
+
+# Typographic punctuation mapped to ASCII when only the Latin-1 core fonts are available
+PDF_ASCII_PUNCTUATION = str.maketrans({
+    "\u2018": "'", "\u2019": "'", "\u201a": "'", "\u201c": '"', "\u201d": '"', "\u201e": '"',
+    "\u2013": "-", "\u2014": "--", "\u2212": "-", "\u2026": "...", "\u2022": "-", "\u00a0": " ",
+    "\u2192": "->", "\u2190": "<-", "\u2713": "v", "\u2714": "v",
+})
+
+def get_pdf_font_paths():
+    for regular, bold in PDF_FONT_CANDIDATES:
+        if regular and os.path.exists(regular):
+            return regular, bold if bold and os.path.exists(bold) else regular
+    return None
+
+def notes_to_pdf(notes_content):
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    font_paths = get_pdf_font_paths()
+    if font_paths:
+        pdf.add_font("NotesFont", "", font_paths[0])
+        pdf.add_font("NotesFont", "B", font_paths[1])
+        font = "NotesFont"
+    else:
+        font = "Helvetica"
+    for line in notes_content.splitlines():
+        if not font_paths:
+            # Core PDF fonts only cover Latin-1, so map typographic punctuation and replace the rest
+            line = line.translate(PDF_ASCII_PUNCTUATION).encode("latin-1", "replace").decode("latin-1")
+        if not line.strip():
+            pdf.ln(4)
+            continue
+        heading = MD_HEADING_RE.match(line)
+        if heading:
+            pdf.set_font(font, "B", max(16 - 2 * len(heading.group(1)), 11))
+            pdf.multi_cell(0, 8, MD_BOLD_RE.sub(r"\1", heading.group(2)), new_x="LMARGIN", new_y="NEXT")
+            continue
+        bullet = MD_BULLET_RE.match(line)
+        if bullet:
+            line = f"- {bullet.group(1)}"
+        # Emit **bold** runs ourselves; fpdf2's markdown mode also reads __ and -- as italic and
+        # underline markers, which breaks on identifiers like __init__ and command-line flags
+        for i, part in enumerate(MD_BOLD_RE.split(line.strip())):
+            if part:
+                pdf.set_font(font, "B" if i % 2 == 1 else "", 11)
+                pdf.write(6, part)
+        pdf.ln(6)
+    return bytes(pdf.output())
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_notes_export(notes_hash, export_format, note_type, _notes_content):
+    """Render notes into the requested format, cached by notes hash (the notes text itself is not hashed)"""
+    if export_format == "Markdown":
+        return _notes_content.encode()
+    if export_format == "HTML":
+        return notes_to_html(_notes_content, note_type).encode()
+    if export_format == "DOCX":
+        return notes_to_docx(_notes_content)
+    if export_format == "PDF":
+        return notes_to_pdf(_notes_content)
+    raise ValueError(f"Unsupported export format: {export_format}")
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def render_notes_zip(library_hash, export_format, _entries):
+    """Bundle the notes for every document in the batch into one zip, cached by the combined notes hash"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for entry in _entries:
+            data = render_notes_export(entry["notes_hash"], export_format, entry["note_type"], entry["notes_content"])
+            zf.writestr(get_export_filename(entry["note_type"], export_format, entry["document_name"]), data)
+    return buffer.getvalue()
+
+# Large-document admission control. Limits can be overridden with environment variables.
+MAX_FILE_MB = float(os.getenv("MAX_FILE_MB", "200"))
+MAX_PAGES = int(os.getenv("MAX_PAGES", "1000"))
+# Pages whose render would exceed this many megapixels are rendered at a lower DPI
+MAX_PAGE_MEGAPIXELS = float(os.getenv("MAX_PAGE_MEGAPIXELS", "12"))
+RENDER_DPI = 200
+MIN_RENDER_DPI = 72
+# Only the first pages are sent to the model as images, so only those pages are rendered
+MODEL_IMAGE_PAGES = 5
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def preflight_pdf(file_hash, _pdf_bytes):
+    """Read page count, largest page size and encryption state without rendering any page.
+
+    Never raises: if neither PyPDF2 nor pdfinfo can read the document, "error" is set instead.
+    """
+    info = {"file_size": len(_pdf_bytes), "page_count": None, "max_page_size": None, "encrypted": False, "error": None}
+    if info["file_size"] > MAX_FILE_MB * 1024 * 1024:
+        # Too large to accept, so don't spend time parsing it
+        return info
+    errors = []
+    try:
+        import PyPDF2
+
+        reader = PyPDF2.PdfReader(io.BytesIO(_pdf_bytes), strict=False)
+        if reader.is_encrypted:
+            # Documents with an empty user password can still be rendered
+            info["encrypted"] = not reader.decrypt("")
+        if not info["encrypted"]:
+            info["page_count"] = len(reader.pages)
+            sizes = [(float(page.cropbox.width), float(page.cropbox.height)) for page in reader.pages]
+            if sizes:
+                info["max_page_size"] = max(sizes, key=lambda size: size[0] * size[1])
+        return info
+    except Exception as e:
+        # Broken xref tables, AES encryption without a crypto backend and the like; try Poppler instead
+        errors.append(f"PyPDF2: {str(e)}")
+        info["encrypted"] = False
+    if PDF2IMAGE_AVAILABLE:
+        try:
+            pdfinfo = pdfinfo_from_bytes(_pdf_bytes)
+            info["encrypted"] = pdfinfo.get("Encrypted", "no").startswith("yes")
+            info["page_count"] = int(pdfinfo["Pages"])
+            match = re.match(r"([\d.]+) x ([\d.]+)", pdfinfo.get("Page size", ""))
+            if match:
+                info["max_page_size"] = (float(match.group(1)), float(match.group(2)))
+            return info
+        except Exception as e:
+            errors.append(f"pdfinfo: {str(e)}")
+    info["error"] = "; ".join(errors)
+    return info
+
+def plan_pdf_processing(info):
+    """Decide whether to reject or downsample a PDF, and describe the limit that applied"""
+    plan = {"reject": False, "dpi": RENDER_DPI, "page_count": info["page_count"], "messages": []}
+    file_mb = info["file_size"] / (1024 * 1024)
+    if file_mb > MAX_FILE_MB:
+        plan["reject"] = True
+        plan["messages"].append(f"The file is {file_mb:.0f} MB, above the {MAX_FILE_MB:.0f} MB limit.")
+    elif info.get("error"):
+        plan["reject"] = True
+        plan["messages"].append(
+            f"The document could not be read and may be damaged or truncated ({info['error']}). "
+            "Try re-saving it as a standard PDF and upload it again."
+        )
+    elif info["encrypted"]:
+        plan["reject"] = True
+        plan["messages"].append("The document is password-protected. Remove the password and upload it again.")
+    elif info["page_count"] and info["page_count"] > MAX_PAGES:
+        plan["reject"] = True
+        plan["messages"].append(f"The document has {info['page_count']} pages, above the {MAX_PAGES}-page limit.")
+    elif info["page_count"] and info["page_count"] > MODEL_IMAGE_PAGES:
+        plan["messages"].append(
+            f"The document has {info['page_count']} pages; only the first {MODEL_IMAGE_PAGES} are rendered for analysis."
+        )
+    if not plan["reject"] and info["max_page_size"]:
+        width_pt, height_pt = info["max_page_size"]
+        megapixels = width_pt * height_pt * (plan["dpi"] / 72) ** 2 / 1_000_000
+        if megapixels > MAX_PAGE_MEGAPIXELS:
+            plan["dpi"] = max(MIN_RENDER_DPI, int(plan["dpi"] * (MAX_PAGE_MEGAPIXELS / megapixels) ** 0.5))
+            plan["messages"].append(
+                f"Pages are very large ({width_pt / 72:.0f} x {height_pt / 72:.0f} in), so they are rendered at {plan['dpi']} DPI."
+            )
+    return plan
+
+# Page thumbnails: rendered at the width they are displayed at, cached by file hash and page
+PREVIEW_THUMBNAIL_WIDTH = 300
+STRIP_THUMBNAIL_WIDTH = 160
+THUMBNAILS_PER_STRIP = 8
+# How often the preview fragment checks for finished thumbnails while some are still rendering
+THUMBNAIL_POLL_SECONDS = 0.5
+
+def get_file_hash(uploaded_file):
+    """Hash the uploaded file once per upload rather than on every rerun"""
+    if st.session_state.file_hash_id != uploaded_file.file_id:
+        st.session_state.file_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        st.session_state.file_hash_id = uploaded_file.file_id
+    return st.session_state.file_hash
+
+@st.cache_resource
+def get_thumbnail_executor():
+    """Worker threads that render thumbnails off the main script thread, shared by all sessions"""
+    workers = int(os.getenv("THUMBNAIL_WORKERS", str(os.cpu_count() or 2)))
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+
+def remember_full_renders(session_id, file_hash, images):
+    """Keep full-resolution renders from notes generation, JPEG-encoded, in the session store"""
+    stored = 0
+    for page_number, image in enumerate(images, 1):
+        try:
+            session_store.set_image(session_id, f"render:{file_hash}:{page_number}", image)
+            stored = page_number
+        except SessionQuotaExceeded:
+            # Renders only save thumbnail work, so skip them when the session is full
+            break
+    # Thumbnails are cached by whether a render existed, so these pages get re-derived from the renders
+    st.session_state.rendered_pages[file_hash] = stored
+
+def has_full_render(file_hash, page_number):
+    return page_number <= st.session_state.rendered_pages.get(file_hash, 0)
+
+def get_full_render(session_id, file_hash, page_number):
+    if session_id is None:
+        return None
+    return session_store.get_image(session_id, f"render:{file_hash}:{page_number}")
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def get_page_thumbnail(file_hash, page_number, width, from_render, _pdf_bytes, _session_id=None):
+    """Return JPEG bytes of one page scaled to the display width.
+
+    from_render is part of the cache key, so a thumbnail rendered by Poppler before notes
+    generation is replaced by one downscaled from the full render once that exists.
+    """
+    image = get_full_render(_session_id, file_hash, page_number) if from_render else None
+    if image is not None:
+        # Downscale the existing render instead of running Poppler again
+        image.thumbnail((width, image.height))
+    else:
+        # Let Poppler scale to the target width directly rather than rendering at a high DPI
+        images = convert_from_bytes(
+            _pdf_bytes,
+            first_page=page_number,
+            last_page=page_number,
+            size=(width, None),
+            fmt='jpeg',
+            thread_count=1,
+            strict=False,
+            use_cropbox=True,
+            transparent=False
+        )
+        if not images:
+            raise Exception(f"Page {page_number} could not be rendered.")
+        image = images[0]
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+def run_with_script_ctx(ctx, func, *args):
+    """Run func on a worker thread with the session's script context attached"""
+    thread = threading.current_thread()
+    add_script_run_ctx(thread, ctx)
+    try:
+        return func(*args)
+    finally:
+        add_script_run_ctx(thread, None)
+
+def request_page_thumbnails(file_hash, requests, pdf_bytes):
+    """Start rendering (page_number, width) thumbnails on the worker threads without waiting for them.
+
+    Returns one future per request. Futures are kept in session state so later reruns pick up
+    the same renders instead of starting new ones.
+    """
+    executor = get_thumbnail_executor()
+    ctx = get_script_run_ctx()
+    futures = {}
+    for page_number, width in requests:
+        from_render = has_full_render(file_hash, page_number)
+        key = (file_hash, page_number, width, from_render)
+        future = st.session_state.thumbnail_futures.get(key)
+        if future is None:
+            future = executor.submit(
+                run_with_script_ctx, ctx, get_page_thumbnail,
+                file_hash, page_number, width, from_render, pdf_bytes, session_id
+            )
+        futures[key] = future
+    # Only keep the futures for what is on screen; finished thumbnails stay in the cache
+    st.session_state.thumbnail_futures = futures
+    return list(futures.values())
+
+def show_thumbnail(future, width, caption):
+    if not future.done():
+        st.caption(f"{caption}: rendering...")
+    elif future.exception() is not None:
+        st.info(f"{caption} not available: {str(future.exception())}")
+    else:
+        st.image(future.result(), caption=caption, width=width)
+
+def get_preview_requests(file_hash, page_count, show_strip, strip):
+    """(page_number, width) of the preview and, if shown, the current strip of thumbnails"""
+    requests = [(1, PREVIEW_THUMBNAIL_WIDTH)]
+    if show_strip:
+        first_page = (strip - 1) * THUMBNAILS_PER_STRIP + 1
+        requests += [
+            (page_number, STRIP_THUMBNAIL_WIDTH)
+            for page_number in range(first_page, min(first_page + THUMBNAILS_PER_STRIP, page_count + 1))
+        ]
+    return requests
+
+def page_previews(file_hash, pdf_bytes, page_count):
+    """First-page preview plus an optional paginated strip of page thumbnails"""
+    # Set by show_page_previews, so it is only present when the whole app is running
+    full_run = st.session_state.pop("thumbnails_full_run", False)
+    preview_slot = st.container()
+    show_strip = bool(page_count) and st.toggle("Show all page thumbnails", key="show_thumbnails")
+    strip = 1
+    strip_count = (page_count + THUMBNAILS_PER_STRIP - 1) // THUMBNAILS_PER_STRIP if page_count else 0
+    if show_strip and strip_count > 1:
+        strip = st.number_input(
+            f"Thumbnail page (1-{strip_count}):",
+            min_value=1,
+            max_value=strip_count,
+            value=1,
+            key=f"thumbnail_strip_{file_hash}"
+        )
+    requests = get_preview_requests(file_hash, page_count, show_strip, strip)
+    futures = request_page_thumbnails(file_hash, requests, pdf_bytes)
+
+    with preview_slot:
+        show_thumbnail(futures[0], PREVIEW_THUMBNAIL_WIDTH, "Preview of first page")
+    if len(requests) > 1:
+        cols = st.columns(THUMBNAILS_PER_STRIP // 2)
+        for i, ((page_number, _), future) in enumerate(zip(requests[1:], futures[1:])):
+            with cols[i % len(cols)]:
+                show_thumbnail(future, STRIP_THUMBNAIL_WIDTH, f"Page {page_number}")
+
+    pending = not all(future.done() for future in futures)
+    # A full app run already chose whether to poll, and rerunning it would drop a button click that
+    # came with it; a fragment rerun (polling, toggling or paging) reruns the app to turn polling on or off
+    if not full_run and pending != st.session_state.thumbnails_polling:
+        st.session_state.thumbnails_polling = pending
+        st.rerun()
+
+def show_page_previews(file_hash, pdf_bytes, page_count):
+    """Show page previews without making the script wait for Poppler.
+
+    Pages that are still rendering show a placeholder; while any are pending the fragment
+    reruns every THUMBNAIL_POLL_SECONDS to fill them in, and paging the strip only reruns
+    the fragment.
+    """
+    # Start the renders from the current widget values so polling is decided before the fragment runs
+    show_strip = bool(page_count) and st.session_state.get("show_thumbnails", False)
+    strip = st.session_state.get(f"thumbnail_strip_{file_hash}", 1)
+    futures = request_page_thumbnails(file_hash, get_preview_requests(file_hash, page_count, show_strip, strip), pdf_bytes)
+    polling = not all(future.done() for future in futures)
+    st.session_state.thumbnails_polling = polling
+    st.session_state.thumbnails_full_run = True
+    fragment = st.fragment(page_previews, run_every=THUMBNAIL_POLL_SECONDS if polling else None)
+    fragment(file_hash, pdf_bytes, page_count)
+
 # Custom CSS for better formatting of notes
 st.markdown("""
 <style>
@@ -138,32 +695,6 @@ st.markdown("""
         font-weight: 500 !important;
     }
     
-        /* Download button */
-    .download-btn {
-        display: inline-block;
-        padding: 0.6rem 1.2rem;
-        background: linear-gradient(90deg, #CF9FFF, #3949AB);
-        color: white !important; /* Force white text with !important */
-        text-decoration: none;
-        border-radius: 8px;
-        font-weight: 500;
-        text-align: center;
-        margin: 1rem 0;
-        box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        transition: all 0.2s ease;
-    }
-
-    .download-btn:hover {
-        box-shadow: 0 4px 10px rgba(0,0,0,0.15);
-        transform: translateY(-2px);
-        color: white !important; /* Maintain white text on hover */
-    }
-
-    .download-btn * {
-        /* Ensure all child elements are also white */
-        color: white !important;
-    }
-    
     /* Chat styling */
     .chat-message {
         padding: 1rem;
@@ -303,16 +834,24 @@ with tab1:
         st.session_state.selected_notes_type = "hinglish"
 
     # Function to extract text from PDF images using pdf2image (Poppler-based)
-    def extract_pdf_text_with_poppler(pdf_bytes):
+    def extract_pdf_text_with_poppler(pdf_bytes, file_hash=None, plan=None):
         """Extract text representation using pdf2image (Poppler-based) to convert PDF to images"""
         if not PDF2IMAGE_AVAILABLE:
             raise ImportError("pdf2image and poppler are required but not installed")
         
+        dpi = plan["dpi"] if plan else RENDER_DPI
+        page_count = plan["page_count"] if plan else None
         try:
+            if page_count is None:
+                page_count = int(pdfinfo_from_bytes(pdf_bytes)["Pages"])
+            
+            # Only the pages sent to the model are rendered, however long the document is
             # Convert PDF to images with additional parameters to handle problematic PDFs
             images = convert_from_bytes(
                 pdf_bytes,
-                dpi=200,  # Higher DPI to ensure better quality
+                first_page=1,
+                last_page=min(MODEL_IMAGE_PAGES, page_count),
+                dpi=dpi,  # Higher DPI to ensure better quality
                 fmt='jpeg',  # Explicitly set format
                 thread_count=1,  # Single-threaded for better stability
                 strict=False,  # Less strict parsing
@@ -326,17 +865,20 @@ with tab1:
             # For text extraction purposes, we'll describe the visual content
             extracted_content = ""
             
-            for i, image in enumerate(images):
-                # Save image to buffer
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='JPEG')
-                img_byte_arr = img_byte_arr.getvalue()
-                
+            for i in range(1, page_count + 1):
                 # Add page marker
-                extracted_content += f"\n\n--- Page {i + 1} ---\n\n"
+                extracted_content += f"\n\n--- Page {i} ---\n\n"
                 # We're not doing OCR here, just using the images directly
-                extracted_content += f"[PDF Page {i + 1} converted to image]"
+                if i <= len(images):
+                    extracted_content += f"[PDF Page {i} converted to image]"
+                else:
+                    extracted_content += f"[PDF Page {i} not rendered]"
+
+            # Keep the full renders so thumbnails of this document can be downscaled from them
+            if file_hash:
+                remember_full_renders(session_id, file_hash, images)
             
+            extracted_content += f"\n\nThe document contains {page_count} pages."
             return extracted_content, images
         except Exception as e:
             raise Exception(f"Error extracting with pdf2image: {str(e)}")
@@ -353,7 +895,7 @@ with tab1:
         return text_content
 
     # Function to process the document (PDF or PPTX)
-    def input_document_setup(uploaded_file):
+    def input_document_setup(uploaded_file, plan=None):
         """Process PDF or PPTX using appropriate extraction methods"""
         if uploaded_file is not None:
             try:
@@ -361,7 +903,7 @@ with tab1:
                 
                 if file_ext == '.pdf':
                     pdf_bytes = uploaded_file.read()
-                    description, images = extract_pdf_text_with_poppler(pdf_bytes)
+                    description, images = extract_pdf_text_with_poppler(pdf_bytes, get_file_hash(uploaded_file), plan)
                     extraction_method = "pdf2image (Poppler)"
                     return description, extraction_method, images
                 
@@ -414,32 +956,33 @@ with tab1:
         else:
             raise FileNotFoundError("No file uploaded")
 
-    # Display document preview when uploaded (only for PDFs)
+    # Display document preview when uploaded (only for PDFs), after a pre-flight check that
+    # decides how large documents are processed
+    pdf_plan = None
     if uploaded_file is not None:
         st.markdown('---', unsafe_allow_html=True)
         st.write("✅ Document uploaded successfully!")
         
         # Try to display first page preview for PDFs
         file_ext = os.path.splitext(uploaded_file.name)[1].lower()
-        if file_ext == '.pdf' and PDF2IMAGE_AVAILABLE:
+        if file_ext == '.pdf':
+            pdf_bytes = uploaded_file.getvalue()
+            file_hash = get_file_hash(uploaded_file)
+            try:
+                pdf_plan = plan_pdf_processing(preflight_pdf(file_hash, pdf_bytes))
+                for message in pdf_plan["messages"]:
+                    if pdf_plan["reject"]:
+                        st.error(message)
+                    else:
+                        st.info(message)
+            except Exception as e:
+                # Never let a document through unchecked
+                pdf_plan = {"reject": True, "dpi": RENDER_DPI, "page_count": None,
+                            "messages": [f"The document could not be checked before processing: {str(e)}"]}
+                st.error(pdf_plan["messages"][0])
+        if file_ext == '.pdf' and PDF2IMAGE_AVAILABLE and not (pdf_plan and pdf_plan["reject"]):
             try:
-                pos = uploaded_file.tell()
-                uploaded_file.seek(0)
-                pdf_bytes = uploaded_file.read()
-                images = convert_from_bytes(
-                    pdf_bytes, 
-                    first_page=1, 
-                    last_page=1,
-                    dpi=200,
-                    fmt='jpeg',
-                    thread_count=1,
-                    strict=False,
-                    use_cropbox=True,
-                    transparent=False
-                )
-                if images:
-                    st.image(images[0], width=300, caption="Preview of first page")
-                uploaded_file.seek(pos)
+                show_page_previews(file_hash, pdf_bytes, pdf_plan["page_count"] if pdf_plan else None)
             except Exception as e:
                 st.info(f"Preview not available: {str(e)}")
         elif file_ext == '.pptx':
@@ -602,28 +1145,22 @@ if st.session_state.selected_notes_type:
         selected_prompt = prompt_hinglish_notes
         note_type = "Hinglish Notes"
 
-    # Function to create a download link for notes
-    def get_download_link(notes_content, note_type):
-        notes_bytes = notes_content.encode()
-        b64 = base64.b64encode(notes_bytes).decode()
-        filename = f"{note_type.replace(' ', '_').lower()}.md"
-        href = f'<a href="data:text/markdown;base64,{b64}" download="{filename}" class="download-btn">Download {note_type}</a>'
-        return href
-
     # Generate notes button
     if st.button("Generate Notes", key="generate_notes", help="Generate the selected type of notes"):
         if uploaded_file is not None:
             if not selected_prompt:
                 st.warning("Please select what type of notes you want first.")
+            elif pdf_plan and pdf_plan["reject"]:
+                st.error(f"Document not processed: {' '.join(pdf_plan['messages'])}")
             else:
                 with st.spinner(f"Analyzing document and generating {note_type}..."):
                     try:
                         # Process the document and prepare the input using extraction methods
-                        description, extraction_method, images = input_document_setup(uploaded_file)
+                        description, extraction_method, images = input_document_setup(uploaded_file, pdf_plan)
                         
                         # For debugging, show the extraction method
-                        #if show_debug:
-                            #st.info(f"Using {extraction_method} for extraction")
+                        if show_debug:
+                            st.info(f"Using {extraction_method} for extraction")
                         
                         # If we have images, display the first 3 for better analysis (only for PDFs)
                         if images and len(images) > 0:
@@ -636,8 +1173,6 @@ if st.session_state.selected_notes_type:
                         
                         # Prepare the prompt for the AI
                         input_content = description
-                        if images:
-                            input_content += f"\n\nThe document contains {len(images)} pages."
                         
                         # Check if we got meaningful content
                         is_extraction_failed = extraction_method.lower() in ["failed", "error"]
@@ -651,17 +1186,16 @@ if st.session_state.selected_notes_type:
                         Ensure your notes are comprehensive but concise, and highlight the most critical information.
                         """
                         
-                        # Generate notes using the Gemini API correctly
-                        model = genai.GenerativeModel(model_name)
+                        # Generate notes using the Gemini API correctly. The document is a fixed prefix shared by
+                        # every notes type, so it is cached per document and the notes prompt is sent with each call.
+                        context_key = f"document:{get_file_hash(uploaded_file)}:{extraction_method}"
+                        started = time.time()
                         
                         # If we have images, we can use them directly withGemini (for PDFs)
                         if images and len(images) > 0:
-                            # For multi-turn conversation with images
-                            chat = model.start_chat(history=[])
-                            
-                            # Process up to first 5 images (to avoid token limits)
+                            # Process up to the first MODEL_IMAGE_PAGES images (to avoid token limits)
                             image_inputs = []
-                            for i, img in enumerate(images[:5]):
+                            for i, img in enumerate(images[:MODEL_IMAGE_PAGES]):
                                 # Convert PIL image to bytes
                                 img_byte_arr = io.BytesIO()
                                 img.save(img_byte_arr, format='PNG')
@@ -673,36 +1207,76 @@ if st.session_state.selected_notes_type:
                                     "data": img_bytes
                                 })
                             
-                            # Send images with context to the model
-                            response = chat.send_message(
-                                content=[
-                                    selected_prompt,
-                                    context_message,
-                                    *image_inputs
-                                ]
+                            # Send the prompt and context to the model after the cached images
+                            context = get_context(
+                                context_key,
+                                model_name,
+                                contents=[{"role": "user", "parts": image_inputs}]
                             )
+                            response = context.generate_content([selected_prompt, context_message])
                             
                             notes_content = response.text
                         else:
                             # Text-only approach for PPTX or failed PDF extraction
-                            prompt_with_context = f"{selected_prompt}\n\n{context_message}\n\nDocument content:\n{input_content}"
+                            context = get_context(
+                                context_key,
+                                model_name,
+                                contents=[{"role": "user", "parts": [f"Document content:\n{input_content}"]}]
+                            )
+                            request_message = context_message
                             
                             # Check if extraction failed or returned empty/error content
                             if is_extraction_failed or not input_content or input_content.strip() == "":
-                                prompt_with_context += "\n\nNOTE: The document extraction failed. Please acknowledge this in your notes and explain what information is missing."
+                                request_message += "\n\nNOTE: The document extraction failed. Please acknowledge this in your notes and explain what information is missing."
                             
-                            response = model.generate_content(prompt_with_context)
+                            response = context.generate_content([selected_prompt, request_message])
                             notes_content = response.text
+                        record_model_call("notes", response, started, context)
                         
-                        # Store the generated content in session state
-                        st.session_state.notes_content = notes_content
-                        st.session_state.note_type = note_type
-                        
-                        # Initialize chat history with the notes as context
-                        st.session_state.chat_history = [
-                            {"role": "user", "parts": [f"Here are the notes from the document: {notes_content}"]},
-                            {"role": "model", "parts": ["Understood, I can answer questions about these notes."]}
+                        # Store the generated content in the session store. Earlier notes of the same type
+                        # for this document are dropped first, so their space can be reused.
+                        notes_hash = get_notes_hash(notes_content)
+                        library = session_store.get_json(session_id, "notes_library", [])
+                        replaced = [
+                            entry for entry in library
+                            if (entry["document_name"], entry["note_type"]) == (uploaded_file.name, note_type)
                         ]
+                        if replaced:
+                            library = [entry for entry in library if entry not in replaced]
+                            session_store.set_json(session_id, "notes_library", library)
+                            for entry in replaced:
+                                delete_notes_if_unused(entry["notes_hash"], library)
+                        
+                        write_with_quota(
+                            lambda: session_store.set_text(session_id, f"notes:{notes_hash}", notes_content),
+                            keep_hash=notes_hash
+                        )
+                        
+                        # Keep the notes for each document so the batch can be exported together. The library
+                        # is re-read on every attempt because making room may drop old entries.
+                        new_entry = {
+                            "document_name": uploaded_file.name,
+                            "note_type": note_type,
+                            "notes_hash": notes_hash,
+                        }
+                        write_with_quota(
+                            lambda: session_store.set_json(
+                                session_id, "notes_library",
+                                session_store.get_json(session_id, "notes_library", []) + [new_entry]
+                            ),
+                            keep_hash=notes_hash
+                        )
+                        
+                        # The current notes are a pointer into the library, not a second copy
+                        write_with_quota(
+                            lambda: session_store.set_json(
+                                session_id, "current_notes", {"notes_hash": notes_hash, "note_type": note_type}
+                            ),
+                            keep_hash=notes_hash
+                        )
+                        
+                        # Start a new chat; the notes are given to the model through the chat context
+                        save_chat_history([])
                         
                     except Exception as e:
                         st.error(f"Error generating notes: {str(e)}")
@@ -712,19 +1286,44 @@ if st.session_state.selected_notes_type:
         else:
             st.warning("Please upload a document first.")
 
-    # Display generated notes if they exist in session state
-    if st.session_state.notes_content:
-        st.markdown(f'<div class="sub-header">{st.session_state.note_type} Generated</div>', unsafe_allow_html=True)
+    # Display generated notes if they exist in the session store
+    notes_content, current_note_type = load_current_notes()
+    if notes_content:
+        st.markdown(f'<div class="sub-header">{current_note_type} Generated</div>', unsafe_allow_html=True)
         
-        st.markdown(st.session_state.notes_content)
+        st.markdown(notes_content)
         st.markdown('</div>', unsafe_allow_html=True)
         
-        # Export button that always appears when notes are available
-        st.markdown(get_download_link(st.session_state.notes_content, st.session_state.note_type), unsafe_allow_html=True)
+        # Export buttons that always appear when notes are available. Files are only
+        # rendered when a download is clicked, and cached by notes hash.
+        export_format = st.selectbox("Export format:", get_available_export_formats(), key="export_format")
+        notes_hash = get_notes_hash(notes_content)
+        st.download_button(
+            f"Download {current_note_type}",
+            data=lambda: render_notes_export(notes_hash, export_format, current_note_type, notes_content),
+            file_name=get_export_filename(current_note_type, export_format),
+            mime=EXPORT_FORMATS[export_format]["mime"],
+            on_click="ignore",
+            key="download_notes"
+        )
+
+        library_entries = session_store.get_json(session_id, "notes_library", [])
+        if len(library_entries) > 1:
+            library_hash = get_notes_hash("".join(entry["notes_hash"] for entry in library_entries))
+            st.download_button(
+                f"Download all notes ({len(library_entries)} documents, .zip)",
+                data=lambda: render_notes_zip(library_hash, export_format, load_notes_library()),
+                file_name="notes_export.zip",
+                mime="application/zip",
+                on_click="ignore",
+                key="download_notes_zip"
+            )
 
 # Chat Tab - new functionality for chatting about the generated notes
 with tab2:
-    if st.session_state.notes_content:
+    notes_content, _ = load_current_notes()
+    if notes_content:
+        chat_history = session_store.get_json(session_id, "chat_history", [])
         st.markdown('<div class="sub-header">Chat About Your Document Notes</div>', unsafe_allow_html=True)
         with st.form(key='chat_form'):
             question = st.text_input("Ask a question about the notes:")
@@ -732,17 +1331,20 @@ with tab2:
         
         if submit_button and question:
             try:
-                model = genai.GenerativeModel(model_name)
-                chat = model.start_chat(history=st.session_state.chat_history)
+                started = time.time()
+                context = get_chat_context(notes_content)
+                chat = context.start_chat(history=chat_history)
                 response = chat.send_message(question)
+                record_model_call("chat", response, started, context)
                 answer = response.text
-                st.session_state.chat_history.append({"role": "user", "parts": [question]})
-                st.session_state.chat_history.append({"role": "model", "parts": [answer]})
+                chat_history.append({"role": "user", "parts": [question]})
+                chat_history.append({"role": "model", "parts": [answer]})
+                save_chat_history(chat_history)
             except Exception as e:
                 st.error(f"Error: {str(e)}")
         
-        # Display conversation history, skipping initial context
-        for msg in st.session_state.chat_history[2:]:
+        # Display conversation history
+        for msg in chat_history:
             if msg["role"] == "user":
                 st.markdown(f"**Q: {msg['parts'][0]}**")
             else:
@@ -750,6 +1352,21 @@ with tab2:
     else:
         st.info("Please generate notes in the PDF Notes tab first.")
 
+# Report session store memory use
+if show_debug:
+    store_stats = session_store.stats(session_id)
+    st.sidebar.caption(
+        f"Session memory: {store_stats['session_bytes'] / 1024:.0f} KB · "
+        f"Store: {store_stats['total_bytes'] / (1024 * 1024):.1f} MB across {store_stats['sessions']} sessions"
+    )
+    last_call = st.session_state.get("last_model_call")
+    if last_call:
+        st.sidebar.caption(
+            f"Last {last_call['stage']} call: {last_call['seconds']:.1f}s, "
+            f"{last_call['prompt_tokens']} prompt tokens ({last_call['cached_tokens'] or 0} cached"
+            f"{', server cache' if last_call['server_cache'] else ', local context'})"
+        )
+
 # Adding footer with helpful information
 st.markdown("---")
 st.markdown("""
@@ -764,7 +1381,7 @@ st.markdown("""
 #### Installation Requirements:
 1. Install Python packages:
    ```
-   pip install streamlit pdf2image PyPDF2 google-generativeai python-dotenv pillow python-pptx
+   pip install streamlit pdf2image PyPDF2 google-generativeai python-dotenv pillow python-pptx markdown python-docx fpdf2
    ```
 2. Install Poppler:
    - Windows: Download from [poppler-windows](https://github.com/oschwartz10612/poppler-windows/releases/)
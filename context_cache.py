@@ -0,0 +1,161 @@
+"""Context caching for Gemini calls.
+
+The fixed prefix of a request (the document for notes generation, or the
+notes plus the seed turns for chat) is registered with the API's
+cached-content facility and referenced by later calls instead of being
+resent. A server-side cache is only created the second time a prefix is used
+within CONTEXT_CACHE_TTL_SECONDS, since a cache that is read once costs more
+than resending the prefix, and only when the prefix is estimated to reach the
+model's minimum cacheable size (CONTEXT_CACHE_MIN_TOKENS). Caches are kept for
+CONTEXT_CACHE_TTL_SECONDS and their TTL is extended while they are in use.
+Otherwise a local context is used that sends the same prefix with every
+request, so callers behave the same either way. Only the prefix is cached:
+the turns of a chat that come after it are still sent with every message.
+"""
+import datetime
+import io
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import google.generativeai as genai
+from PIL import Image
+
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE", "on").lower() not in ("off", "0", "false")
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Smallest prefix the API will cache; shorter prefixes are resent without trying
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+# Uses of a prefix, within its TTL, before a server-side cache is created for it
+CONTEXT_CACHE_MIN_USES = 2
+# Extend a server-side cache's TTL once less than this much of it is left
+REFRESH_MARGIN_SECONDS = 300
+# Token cost of one image tile, and the tile size that larger images are split into
+IMAGE_TILE_TOKENS = 258
+IMAGE_TILE_PIXELS = 768
+
+_lock = threading.Lock()
+# key -> {"cached_content": CachedContent or None, "expires": float, "uses": int, "attempted": bool}
+_entries = {}
+# key -> {"lock": Lock, "users": int}, held while that key's entry is looked up, created or refreshed
+# so concurrent sessions for the same document register one server-side cache, not one each. An
+# entry only exists while some thread is using or waiting for the lock.
+_key_locks = {}
+
+
+class CachedContext:
+    """A model bound to a request prefix, either cached server-side or resent locally"""
+
+    def __init__(self, model, prefix, server_side):
+        self.model = model
+        self.prefix = prefix
+        self.server_side = server_side
+
+    def start_chat(self, history=()):
+        return self.model.start_chat(history=[*self.prefix, *history])
+
+    def generate_content(self, parts):
+        contents = [*self.prefix]
+        if contents and contents[-1]["role"] == "user":
+            # Fold the new parts into the trailing user turn, as the cached prefix would be followed
+            contents[-1] = {"role": "user", "parts": [*contents[-1]["parts"], *parts]}
+        else:
+            contents.append({"role": "user", "parts": list(parts)})
+        return self.model.generate_content(contents)
+
+
+def estimate_tokens(system_instruction, contents):
+    """Rough token count of a prefix: about four characters per token, and a fixed cost per image tile"""
+    parts = [system_instruction] if system_instruction else []
+    for content in contents:
+        parts.extend(content["parts"])
+    tokens = 0
+    for part in parts:
+        if isinstance(part, dict) and str(part.get("mime_type", "")).startswith("image/"):
+            width, height = Image.open(io.BytesIO(part["data"])).size
+            tiles = 1 if max(width, height) <= 384 else (
+                math.ceil(width / IMAGE_TILE_PIXELS) * math.ceil(height / IMAGE_TILE_PIXELS)
+            )
+            tokens += tiles * IMAGE_TILE_TOKENS
+        else:
+            tokens += len(str(part)) // 4
+    return tokens
+
+
+def _create_cached_content(model_name, system_instruction, contents, ttl_seconds):
+    try:
+        return genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            contents=contents,
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+    except Exception:
+        # Fall back to resending the prefix; try the server again once this entry expires
+        return None
+
+
+def _delete_cached_content(cached_content):
+    try:
+        cached_content.delete()
+    except Exception:
+        # It expires on its own at the end of its TTL
+        pass
+
+
+@contextmanager
+def _key_lock(key):
+    """Hold the lock for key; it is dropped once no thread is using or waiting for it"""
+    with _lock:
+        key_lock = _key_locks.setdefault(key, {"lock": threading.Lock(), "users": 0})
+        key_lock["users"] += 1
+    try:
+        with key_lock["lock"]:
+            yield
+    finally:
+        with _lock:
+            key_lock["users"] -= 1
+            if not key_lock["users"]:
+                del _key_locks[key]
+
+
+def get_context(key, model_name, system_instruction=None, contents=(), ttl_seconds=CONTEXT_CACHE_TTL_SECONDS):
+    """Return a CachedContext for the prefix identified by key, caching it server-side once it is reused"""
+    contents = list(contents)
+    with _key_lock(key):
+        now = time.time()
+        with _lock:
+            entry = _entries.get(key)
+        if entry is None or entry["expires"] <= now:
+            entry = {"cached_content": None, "expires": now + ttl_seconds, "uses": 0, "attempted": False}
+        entry["uses"] += 1
+        if entry["cached_content"] is None:
+            # Keep counting uses of a prefix that is resent locally for another TTL
+            entry["expires"] = now + ttl_seconds
+            if (
+                CONTEXT_CACHE_ENABLED
+                and not entry["attempted"]
+                and entry["uses"] >= CONTEXT_CACHE_MIN_USES
+                and estimate_tokens(system_instruction, contents) >= CONTEXT_CACHE_MIN_TOKENS
+            ):
+                entry["attempted"] = True
+                entry["cached_content"] = _create_cached_content(model_name, system_instruction, contents, ttl_seconds)
+        elif entry["expires"] - now < REFRESH_MARGIN_SECONDS:
+            try:
+                entry["cached_content"].update(ttl=datetime.timedelta(seconds=ttl_seconds))
+                entry["expires"] = now + ttl_seconds
+            except Exception:
+                # Replace the cache rather than keep paying for one that can no longer be extended
+                _delete_cached_content(entry["cached_content"])
+                entry["cached_content"] = _create_cached_content(model_name, system_instruction, contents, ttl_seconds)
+                entry["expires"] = now + ttl_seconds
+        with _lock:
+            _entries[key] = entry
+            # Forget entries whose caches have expired on the server or whose prefixes have gone unused
+            for expired_key in [k for k, e in _entries.items() if e["expires"] <= now]:
+                del _entries[expired_key]
+
+    if entry["cached_content"] is not None:
+        return CachedContext(genai.GenerativeModel.from_cached_content(entry["cached_content"]), [], True)
+    return CachedContext(genai.GenerativeModel(model_name, system_instruction=system_instruction), contents, False)
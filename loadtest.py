@@ -0,0 +1,507 @@
+"""Load-test harness for app.py.
+
+Simulates many concurrent users of the app with Streamlit's AppTest. Each
+simulated session uploads a document from a synthetic corpus, generates notes,
+exports them in every format and asks chat questions. Model calls go to a local stub with configurable
+latency, so the results reflect the app's own cost and not the Gemini API's.
+The report covers throughput, p50/p95/p99 latency per stage, peak RSS and CPU
+use of the harness and its workers.
+
+AppTest keeps the Streamlit runtime in a process-wide global, so it cannot run
+two sessions at once in one process. Each of the --concurrency workers is a
+separate process that runs its sessions one after another. Sessions in the
+same worker share its Streamlit caches and in-memory session store; sessions
+in different workers do not, unlike users of one Streamlit server, so cache
+hit rates are lower and total memory higher than in production. With
+SESSION_STORE=sqlite all workers share one store file.
+
+File uploads need a Streamlit version whose AppTest supports file_uploader.
+Poppler (pdftoppm and pdfinfo) must be installed, since PDF rendering is most
+of the app's cost; without it PDFs take the PyPDF2 text fallback and the run
+is refused unless --allow-text-fallback is given. The report lists which
+extraction method each session used, as shown by the app's debug output.
+
+--smoke runs the same sessions at concurrency 1 first and fails if running
+them concurrently produces errors the sequential run did not.
+
+Usage:
+    python loadtest.py --sessions 50 --concurrency 10 --model-latency 1.5
+"""
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+STAGES = ["load", "upload", "generate", "export", "chat"]
+POPPLER_TOOLS = ["pdftoppm", "pdfinfo"]
+
+
+def missing_poppler_tools():
+    return [tool for tool in POPPLER_TOOLS if shutil.which(tool) is None]
+
+
+# Local model stub
+
+def install_model_stub(latency, jitter, server_cache):
+    """Replace google.generativeai with a stub that sleeps instead of calling the API"""
+
+    def wait():
+        time.sleep(max(0.0, random.gauss(latency, jitter)))
+
+    def estimate_tokens(contents):
+        return len(str(contents)) // 4
+
+    class Usage:
+        def __init__(self, prompt_tokens, cached_tokens):
+            self.prompt_token_count = prompt_tokens
+            self.cached_content_token_count = cached_tokens
+
+    class Response:
+        def __init__(self, text, usage):
+            self.text = text
+            self.usage_metadata = usage
+
+    class Chat:
+        def __init__(self, model, history):
+            self.model = model
+            self.history = list(history or [])
+
+        def send_message(self, content, **kwargs):
+            wait()
+            prompt_tokens = estimate_tokens(self.history) + estimate_tokens(content) + self.model.cached_tokens
+            self.history.append({"role": "user", "parts": [content]})
+            answer = "This is a stubbed answer about the **key terms** in the notes."
+            self.history.append({"role": "model", "parts": [answer]})
+            return Response(answer, Usage(prompt_tokens, self.model.cached_tokens))
+
+    class GenerativeModel:
+        def __init__(self, model_name=None, system_instruction=None, **kwargs):
+            self.cached_tokens = 0
+            self.system_instruction = system_instruction
+
+        @classmethod
+        def from_cached_content(cls, cached_content):
+            model = cls()
+            model.cached_tokens = cached_content.tokens
+            return model
+
+        def start_chat(self, history=None):
+            return Chat(self, history)
+
+        def generate_content(self, contents, **kwargs):
+            wait()
+            prompt_tokens = estimate_tokens(contents) + estimate_tokens(self.system_instruction) + self.cached_tokens
+            # Identifiers with __ and command-line flags with -- have broken the PDF exporter before
+            notes = (
+                "# Overview\n\nStubbed notes \u2014 \u201cquoted\u201d.\n\n## Key Points\n- **First term** explained\n"
+                "- **Second term** calls __init__ on snake__case objects\n1. Run `tool --verbose` -- then check\n"
+            )
+            return Response(notes, Usage(prompt_tokens, self.cached_tokens))
+
+    class CachedContent:
+        @classmethod
+        def create(cls, model=None, system_instruction=None, contents=None, ttl=None, **kwargs):
+            if not server_cache:
+                raise Exception("Context caching disabled in the model stub")
+            cached_content = cls()
+            cached_content.tokens = estimate_tokens(contents) + estimate_tokens(system_instruction)
+            return cached_content
+
+        def update(self, **kwargs):
+            pass
+
+    stub = types.ModuleType("google.generativeai")
+    stub.configure = lambda **kwargs: None
+    stub.GenerativeModel = GenerativeModel
+    stub.caching = types.SimpleNamespace(CachedContent=CachedContent)
+    sys.modules["google.generativeai"] = stub
+    os.environ.setdefault("GOOGLE_API_KEY", "load-test")
+
+
+# Synthetic corpus
+
+WORDS = (
+    "analysis system model data process result method value network energy policy market "
+    "structure function design performance theory practice evidence research review"
+).split()
+
+
+def make_text(rng, sentences):
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+
+def make_pdf(rng, pages):
+    """Build a small text PDF by hand so the corpus needs no PDF-writing dependency"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for _ in range(pages):
+        lines = [make_text(rng, 1)[:90] for _ in range(30)]
+        stream = "BT /F1 11 Tf 50 780 Td 14 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {pages} >>"
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = output.tell()
+    output.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        output.write(f"{offset:010d} 00000 n \n".encode())
+    output.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return output.getvalue()
+
+
+def make_pptx(rng, slides):
+    from pptx import Presentation
+
+    prs = Presentation()
+    for i in range(slides):
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        slide.shapes.title.text = f"Section {i + 1}: {make_text(rng, 1)[:40]}"
+        slide.placeholders[1].text = "\n".join(make_text(rng, 1) for _ in range(4))
+    output = io.BytesIO()
+    prs.save(output)
+    return output.getvalue()
+
+
+def build_corpus(documents, pages, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(documents):
+        if i % 2 == 0:
+            corpus.append((f"synthetic_{i}.pdf", make_pdf(rng, pages), "application/pdf"))
+        else:
+            corpus.append((
+                f"synthetic_{i}.pptx",
+                make_pptx(rng, pages),
+                "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+            ))
+    return corpus
+
+
+# Resource sampling
+
+def read_process_tree_usage():
+    """Return (RSS bytes, CPU seconds) of this process and its worker processes"""
+    try:
+        page_size, ticks = os.sysconf("SC_PAGE_SIZE"), os.sysconf("SC_CLK_TCK")
+        pids = [os.getpid()]
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as stat:
+                        # Fields after the command name, which may itself contain spaces
+                        if int(stat.read().rsplit(")", 1)[1].split()[1]) == os.getpid():
+                            pids.append(int(entry))
+                except (OSError, ValueError, IndexError):
+                    # The process exited while the list was read
+                    continue
+        rss, cpu = 0, 0.0
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/statm") as statm:
+                    rss += int(statm.read().split()[1]) * page_size
+                with open(f"/proc/{pid}/stat") as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+                    cpu += (int(fields[11]) + int(fields[12])) / ticks
+            except (OSError, ValueError, IndexError):
+                continue
+        return rss, cpu
+    except OSError:
+        # No /proc: ru_maxrss is already a peak (KB on Linux, bytes on macOS) and child CPU is
+        # only counted once the workers exit
+        scale = 1 if sys.platform == "darwin" else 1024
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        return (
+            sum(u.ru_maxrss for u in usage) * scale,
+            sum(u.ru_utime + u.ru_stime for u in usage),
+        )
+
+
+class ResourceSampler(threading.Thread):
+    """Sample RSS and CPU time of the harness and its workers in the background"""
+
+    def __init__(self, interval=0.25):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss = read_process_tree_usage()[0]
+        self.peak_cpu_cores = 0.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        last_wall, (_, last_cpu) = time.monotonic(), read_process_tree_usage()
+        while not self.stopped.wait(self.interval):
+            wall, (rss, cpu) = time.monotonic(), read_process_tree_usage()
+            self.peak_cpu_cores = max(self.peak_cpu_cores, (cpu - last_cpu) / (wall - last_wall))
+            last_wall, last_cpu = wall, cpu
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Session driver
+
+# file_id -> data callable of each deferred download button, which AppTest never calls itself
+DEFERRED_DOWNLOADS = {}
+
+
+def install_download_capture():
+    from streamlit.runtime.media_file_manager import MediaFileManager
+
+    add_deferred = MediaFileManager.add_deferred
+
+    def capture(self, data_callable, *args, **kwargs):
+        file_id = add_deferred(self, data_callable, *args, **kwargs)
+        DEFERRED_DOWNLOADS[file_id] = data_callable
+        return file_id
+
+    MediaFileManager.add_deferred = capture
+
+
+def start_worker(model_latency, model_jitter, server_cache, ready):
+    """Set up a worker process, which runs one session at a time, then wait for the other workers"""
+    try:
+        install_model_stub(model_latency, model_jitter, server_cache)
+        install_download_capture()
+        # Load the app once, untimed, so importing it and its dependencies is not counted as a page load
+        from streamlit.testing.v1 import AppTest
+
+        AppTest.from_file(APP_PATH, default_timeout=120).run()
+    finally:
+        ready.wait()
+
+
+def run_session(index, corpus, questions, timeout):
+    """Drive one simulated user through the app and return per-stage latencies and the extraction method"""
+    from streamlit.testing.v1 import AppTest
+
+    timings = {stage: [] for stage in STAGES}
+    # Workers run one session at a time, so only this session's downloads are kept
+    DEFERRED_DOWNLOADS.clear()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+    def timed(stage, element=None):
+        started = time.perf_counter()
+        if element is not None:
+            element.run()
+        else:
+            at.run()
+        timings[stage].append(time.perf_counter() - started)
+        if at.exception:
+            raise RuntimeError(f"{stage}: {at.exception[0].message}")
+
+    timed("load")
+    at.file_uploader[0].set_value(corpus[index % len(corpus)])
+    timed("upload")
+    at.button(key="generate_notes").click()
+    timed("generate")
+    if not any("Generated" in markdown.value for markdown in at.markdown):
+        raise RuntimeError("generate: no notes were shown")
+    # The app's debug output names the extraction method it used
+    extraction_method = next(
+        (info.value[len("Using "):-len(" for extraction")] for info in at.info
+         if info.value.startswith("Using ") and info.value.endswith(" for extraction")),
+        "unknown"
+    )
+    export_format = at.selectbox(key="export_format")
+    for option in export_format.options:
+        export_format.set_value(option).run()
+        download = at.download_button(key="download_notes")
+        started = time.perf_counter()
+        try:
+            data = DEFERRED_DOWNLOADS.pop(download.proto.deferred_file_id)()
+        except Exception as e:
+            raise RuntimeError(f"export: {option}: {e}")
+        timings["export"].append(time.perf_counter() - started)
+        if not data:
+            raise RuntimeError(f"export: {option} produced an empty file")
+    for question in questions:
+        next(text_input for text_input in at.text_input if text_input.label == "Ask a question about the notes:").input(question)
+        next(button for button in at.button if button.label == "Ask").click()
+        timed("chat")
+    return timings, extraction_method
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank percentile
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def run_load_test(args):
+    corpus = build_corpus(args.documents, args.pages, args.seed)
+    questions = [f"What does the document say about {word}?" for word in WORDS[:args.questions]]
+
+    timings = {stage: [] for stage in STAGES}
+    extraction_methods = {}
+    errors = []
+    context = multiprocessing.get_context("spawn")
+    # Workers are started as sessions are submitted, so there are never more than there are sessions
+    ready = context.Barrier(min(args.sessions, args.concurrency) + 1)
+    sampler = ResourceSampler()
+    with ProcessPoolExecutor(
+        max_workers=args.concurrency,
+        mp_context=context,
+        initializer=start_worker,
+        initargs=(args.model_latency, args.model_jitter, args.server_cache, ready),
+    ) as executor:
+        futures = [
+            executor.submit(run_session, index, corpus, questions, args.timeout)
+            for index in range(args.sessions)
+        ]
+        # Start measuring once every worker has loaded the app
+        ready.wait(timeout=args.timeout)
+        sampler.start()
+        started = time.perf_counter()
+        for future in futures:
+            try:
+                session_timings, extraction_method = future.result()
+                for stage, values in session_timings.items():
+                    timings[stage].extend(values)
+                extraction_methods[extraction_method] = extraction_methods.get(extraction_method, 0) + 1
+            except Exception as e:
+                errors.append(str(e))
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+
+    completed = args.sessions - len(errors)
+    return {
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "model_latency": args.model_latency,
+        "completed": completed,
+        "errors": errors,
+        "missing_poppler_tools": missing_poppler_tools(),
+        "extraction_methods": extraction_methods,
+        "elapsed_seconds": elapsed,
+        "sessions_per_second": completed / elapsed,
+        "requests_per_second": sum(len(values) for values in timings.values()) / elapsed,
+        "stages": {
+            stage: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+            for stage, values in timings.items()
+        },
+        "peak_rss_mb": sampler.peak_rss / (1024 * 1024),
+        "peak_cpu_cores": sampler.peak_cpu_cores,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_report(report):
+    print(
+        f"{report['completed']}/{report['sessions']} sessions completed in {report['elapsed_seconds']:.1f}s "
+        f"at concurrency {report['concurrency']} (model latency {report['model_latency']}s)"
+    )
+    print(f"Throughput: {report['sessions_per_second']:.2f} sessions/s, {report['requests_per_second']:.2f} requests/s")
+    print(f"{'stage':<10}{'count':>7}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}")
+    for stage, stats in report["stages"].items():
+        if stats["count"]:
+            print(f"{stage:<10}{stats['count']:>7}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}")
+    print("Extraction methods: " + ", ".join(
+        f"{method} x{count}" for method, count in sorted(report["extraction_methods"].items())
+    ))
+    if report["missing_poppler_tools"]:
+        print(
+            f"Warning: {', '.join(report['missing_poppler_tools'])} not found; PDFs used the text fallback, "
+            "so page rendering and thumbnail cost was not measured"
+        )
+    print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB")
+    print(
+        f"Peak CPU: {report['peak_cpu_cores']:.2f} cores "
+        f"({report['peak_cpu_cores'] / report['cpu_count']:.0%} of {report['cpu_count']} CPUs)"
+    )
+    for error in report["errors"][:10]:
+        print(f"Error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent sessions against app.py")
+    parser.add_argument("--sessions", type=int, default=20, help="total sessions to run")
+    parser.add_argument("--concurrency", type=int, default=5, help="sessions running at the same time")
+    parser.add_argument("--questions", type=int, default=3, help="chat questions per session")
+    parser.add_argument("--documents", type=int, default=6, help="documents in the synthetic corpus")
+    parser.add_argument("--pages", type=int, default=5, help="pages or slides per synthetic document")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="mean seconds per stubbed model call")
+    parser.add_argument("--model-jitter", type=float, default=0.2, help="standard deviation of the model latency")
+    parser.add_argument("--server-cache", action="store_true", help="let the stub accept context caches")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed for one app run")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic corpus")
+    parser.add_argument("--json", help="also write the report to this file as JSON")
+    parser.add_argument(
+        "--smoke", action="store_true",
+        help="also run the sessions at concurrency 1 and fail on errors that only happen concurrently"
+    )
+    parser.add_argument(
+        "--allow-text-fallback", action="store_true",
+        help="run even if Poppler is missing (PDFs then skip rendering, so results understate capacity needs)"
+    )
+    args = parser.parse_args()
+
+    missing = missing_poppler_tools()
+    if missing and not args.allow_text_fallback:
+        print(
+            f"Error: {', '.join(missing)} not found on PATH. Install Poppler so PDF rendering is measured, "
+            "or pass --allow-text-fallback to measure the PyPDF2 text path instead.",
+            file=sys.stderr
+        )
+        return 2
+
+    baseline = run_load_test(argparse.Namespace(**{**vars(args), "concurrency": 1})) if args.smoke else None
+    report = run_load_test(args)
+    print_report(report)
+    if baseline is not None:
+        # Errors the sessions also hit one at a time are app failures; the rest come from running concurrently
+        report["sequential_errors"] = baseline["errors"]
+        report["concurrency_only_errors"] = sorted(set(report["errors"]) - set(baseline["errors"]))
+        print(
+            f"Smoke check: {len(baseline['errors'])} errors at concurrency 1, "
+            f"{len(report['concurrency_only_errors'])} only at concurrency {args.concurrency}"
+        )
+        for error in baseline["errors"][:10]:
+            print(f"Sequential error: {error}")
+        for error in report["concurrency_only_errors"][:10]:
+            print(f"Concurrency-only error: {error}")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(report, output, indent=2)
+    if baseline is not None:
+        return 1 if report["concurrency_only_errors"] else 0
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    # AppTest replaces __main__ with the app in the workers, so run through the module by name
+    # for the functions sent to them to be found
+    import loadtest
+
+    sys.exit(loadtest.main())
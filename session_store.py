@@ -0,0 +1,291 @@
+"""Compact per-session storage for the Streamlit app.
+
+Session data (notes, chat history, page renders) is kept as compressed text
+and encoded image bytes instead of Python strings and PIL objects. The store
+keeps running byte counts per session and in total, caps the size of a single
+session, and evicts idle or least recently used sessions when the global
+budget is exceeded. SQLiteSessionStore keeps the same data in a local SQLite
+file so several app processes can share one store; its quota checks and
+writes run in one transaction so processes cannot both pass the same check.
+"""
+import io
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from PIL import Image
+
+
+class SessionQuotaExceeded(Exception):
+    """Raised when a write would push a session over its byte limit"""
+
+
+class SessionStore:
+    """In-process session store with memory accounting and LRU eviction"""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, max_session_bytes=32 * 1024 * 1024, idle_seconds=3600):
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self.idle_seconds = idle_seconds
+        self._lock = threading.RLock()
+        # session_id -> {"last_access": float, "bytes": int, "values": {key: bytes}}, least recently used first
+        self._sessions = OrderedDict()
+        self._total_bytes = 0
+
+    # Raw byte storage, overridden by persistent backends
+
+    @contextmanager
+    def _transaction(self):
+        """Hold the store while a quota check and the write it allows happen together"""
+        with self._lock:
+            yield
+
+    def _get(self, session_id, key):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session["values"].get(key) if session else None
+
+    def _set(self, session_id, key, data):
+        with self._lock:
+            session = self._sessions.setdefault(session_id, {"last_access": time.time(), "bytes": 0, "values": {}})
+            growth = len(data) - len(session["values"].get(key, b""))
+            session["values"][key] = data
+            session["bytes"] += growth
+            self._total_bytes += growth
+
+    def _delete(self, session_id, key):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session and key in session["values"]:
+                size = len(session["values"].pop(key))
+                session["bytes"] -= size
+                self._total_bytes -= size
+
+    def _touch(self, session_id):
+        with self._lock:
+            session = self._sessions.setdefault(session_id, {"last_access": 0, "bytes": 0, "values": {}})
+            session["last_access"] = time.time()
+            self._sessions.move_to_end(session_id)
+
+    def _sessions_by_last_access(self):
+        """Return (session_id, last_access) pairs, least recently used first"""
+        with self._lock:
+            return [(session_id, session["last_access"]) for session_id, session in self._sessions.items()]
+
+    def _oldest_last_access(self):
+        with self._lock:
+            return next(iter(self._sessions.values()))["last_access"] if self._sessions else None
+
+    def keys(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return list(session["values"]) if session else []
+
+    def delete_session(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session:
+                self._total_bytes -= session["bytes"]
+
+    def session_bytes(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session["bytes"] if session else 0
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total_bytes
+
+    # Accounting and eviction
+
+    def _write(self, session_id, key, data):
+        with self._transaction():
+            current_size = len(self._get(session_id, key) or b"")
+            new_size = self.session_bytes(session_id) - current_size + len(data)
+            # Writes that don't grow the session are always allowed, so a full session can shrink
+            if new_size > self.max_session_bytes and len(data) > current_size:
+                raise SessionQuotaExceeded(
+                    f"Session would hold {new_size} bytes, above the {self.max_session_bytes}-byte limit"
+                )
+            self._set(session_id, key, data)
+            self._touch(session_id)
+            self.evict(keep=session_id)
+
+    def evict(self, keep=None):
+        """Drop idle sessions, then least recently used ones while the store is over budget"""
+        with self._transaction():
+            now = time.time()
+            total = self.total_bytes()
+            oldest = self._oldest_last_access()
+            if total <= self.max_bytes and (oldest is None or now - oldest <= self.idle_seconds):
+                return
+            # Oldest first, so once a session is neither idle nor needed to get under budget, none after it are
+            for session_id, last_access in self._sessions_by_last_access():
+                if session_id == keep:
+                    continue
+                if now - last_access <= self.idle_seconds and total <= self.max_bytes:
+                    break
+                total -= self.session_bytes(session_id)
+                self.delete_session(session_id)
+
+    def touch(self, session_id):
+        """Mark a session as active so it is not evicted as idle"""
+        self._touch(session_id)
+
+    def stats(self, session_id=None):
+        stats = {"sessions": len(self._sessions_by_last_access()), "total_bytes": self.total_bytes()}
+        if session_id is not None:
+            stats["session_bytes"] = self.session_bytes(session_id)
+        return stats
+
+    # Typed accessors
+
+    def delete(self, session_id, key):
+        self._delete(session_id, key)
+
+    def get_text(self, session_id, key, default=None):
+        data = self._get(session_id, key)
+        return zlib.decompress(data).decode() if data is not None else default
+
+    def set_text(self, session_id, key, text):
+        self._write(session_id, key, zlib.compress(text.encode()))
+
+    def get_json(self, session_id, key, default=None):
+        text = self.get_text(session_id, key)
+        return json.loads(text) if text is not None else default
+
+    def set_json(self, session_id, key, value):
+        self.set_text(session_id, key, json.dumps(value))
+
+    def get_image(self, session_id, key):
+        data = self._get(session_id, key)
+        return Image.open(io.BytesIO(data)) if data is not None else None
+
+    def set_image(self, session_id, key, image, quality=85):
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+        self._write(session_id, key, buffer.getvalue())
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store backed by a local SQLite file that several app processes can share"""
+
+    def __init__(self, path, **limits):
+        super().__init__(**limits)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._in_transaction = False
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction():
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_values ("
+                "session_id TEXT, key TEXT, value BLOB, PRIMARY KEY (session_id, key))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, last_access REAL, bytes INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")]
+            if "bytes" not in columns:
+                # Store files created before sessions kept a byte count
+                self._conn.execute("ALTER TABLE sessions ADD COLUMN bytes INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute(
+                    "UPDATE sessions SET bytes = (SELECT COALESCE(SUM(LENGTH(value)), 0) FROM session_values "
+                    "WHERE session_values.session_id = sessions.session_id)"
+                )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access)")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the database write lock up front, so a quota check and its write are
+        # atomic across processes as well as threads
+        with self._lock:
+            if self._in_transaction:
+                yield
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+            finally:
+                self._in_transaction = False
+
+    def _get(self, session_id, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM session_values WHERE session_id = ? AND key = ?", (session_id, key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _value_size(self, session_id, key):
+        row = self._conn.execute(
+            "SELECT LENGTH(value) FROM session_values WHERE session_id = ? AND key = ?", (session_id, key)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _add_session_bytes(self, session_id, growth):
+        self._conn.execute(
+            "INSERT INTO sessions (session_id, last_access, bytes) VALUES (?, ?, ?) "
+            "ON CONFLICT (session_id) DO UPDATE SET bytes = bytes + excluded.bytes",
+            (session_id, time.time(), growth),
+        )
+
+    def _set(self, session_id, key, data):
+        with self._transaction():
+            growth = len(data) - self._value_size(session_id, key)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO session_values (session_id, key, value) VALUES (?, ?, ?)",
+                (session_id, key, data),
+            )
+            self._add_session_bytes(session_id, growth)
+
+    def _delete(self, session_id, key):
+        with self._transaction():
+            size = self._value_size(session_id, key)
+            self._conn.execute("DELETE FROM session_values WHERE session_id = ? AND key = ?", (session_id, key))
+            if size:
+                self._add_session_bytes(session_id, -size)
+
+    def _touch(self, session_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, last_access) VALUES (?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET last_access = excluded.last_access",
+                (session_id, time.time()),
+            )
+
+    def keys(self, session_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM session_values WHERE session_id = ?", (session_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def _sessions_by_last_access(self):
+        with self._lock:
+            return self._conn.execute("SELECT session_id, last_access FROM sessions ORDER BY last_access").fetchall()
+
+    def _oldest_last_access(self):
+        with self._lock:
+            return self._conn.execute("SELECT MIN(last_access) FROM sessions").fetchone()[0]
+
+    def delete_session(self, session_id):
+        with self._transaction():
+            self._conn.execute("DELETE FROM session_values WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def session_bytes(self, session_id):
+        with self._lock:
+            row = self._conn.execute("SELECT bytes FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def total_bytes(self):
+        # Sums one counter per session rather than every stored value
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM sessions").fetchone()[0]